@@ -1,13 +1,16 @@
 #/usr/bin/env python3
 
+import time
+STARTED = time.perf_counter()
+
 import os
 import json
-import webpy
 import sys
 import argparse
-import datetime
-import requests
-import shutil
+import threading
+# webpy and shutil are imported where they are needed, so that -h, bad
+# arguments and the update check don't pay for them. webpy itself only
+# imports requests once the first request is sent
 
 if sys.version_info < (3,0,0):
     print("ERROR: Please run with Python 3!")
@@ -18,50 +21,130 @@ mydir = os.path.dirname(os.path.abspath(__file__))
 
 SERVER_HOSTNAME = "128.30.195.11"
 SERVER_PORT = 39284
+# MINIPLACES_SERVER=host:port points the grader elsewhere, e.g. at a local miniplaces_server.py
+if os.environ.get("MINIPLACES_SERVER"):
+    SERVER_HOSTNAME, SERVER_PORT = os.environ["MINIPLACES_SERVER"].rsplit(":", 1)
+    SERVER_PORT = int(SERVER_PORT)
 
 MY_VERSION = (1,0,2)
 
-client = webpy.WebPyClient(SERVER_HOSTNAME, SERVER_PORT, codec=webpy.WebPyJSONCodec)
-
-def check_for_updates():
-    response = requests.get('http://6.869.csail.mit.edu/fa19/miniplaces_part2/client_version.txt')
-    if response.status_code == 200:
-        curr_ver = tuple(map(int, response.text.split('.')))
-    if curr_ver > MY_VERSION:
-        print("Sorry! Not using the newest Miniplaces Client version.")
-        if input("May I update? (Y/N)").lower().startswith('y'):
-            print("Updating...")
-            response_updated = requests.get('http://6.869.csail.mit.edu/fa19/miniplaces_part2/client.py')
-            if response_updated.status_code == 200:
-                with open(os.path.join(mydir, "updated_client.py"), "wb") as f:
-                    f.write(response_updated.content)
-                print("Swapping...")
-                shutil.copy2(os.path.join(mydir, "updated_client.py"), __file__)
-                try:
-                    os.remove(os.path.join(mydir, "updated_client.py"))
-                except:
-                    print("Couldn't remove updated_client.py. Please remove manually.")
-                print("Swap successful! (I think). Exiting... Rerun for latest updates")
-                sys.exit(0)
-            else:
-                print("Failed to fetch updates! Try going to:\n%s\nto manually replace this file" % "http://6.869.csail.mit.edu/fa19/miniplaces_part2/client.py")
-                sys.exit(1)
-    else:
-        print("Newest version!")
-            
+VERSION_URL = 'http://6.869.csail.mit.edu/fa19/miniplaces_part2/client_version.txt'
+CLIENT_URL = 'http://6.869.csail.mit.edu/fa19/miniplaces_part2/client.py'
+# The newest version seen, and when, so most runs skip the network entirely
+VERSION_CACHE = ".client_version.json"
+VERSION_CHECK_TTL = 24 * 60 * 60
+VERSION_CHECK_TIMEOUT = 2
+# Seconds from start to the first client being built (importing webpy
+# included); --timing warns past it
+STARTUP_BUDGET = 0.05
+
+_client = None
+_client_ready = None
+_team_id = None
+
+def get_client():
+    global _client, _client_ready
+    if _client is None:
+        import webpy
+        _client = webpy.WebPyClient(SERVER_HOSTNAME, SERVER_PORT, codec=webpy.WebPyJSONCodec)
+        _client_ready = time.perf_counter()
+    return _client
+
+def read_cached_version():
+    ''' (newest version, time it was checked) from the cache file, or (None, 0) '''
+    try:
+        with open(os.path.join(mydir, VERSION_CACHE), 'r') as f:
+            cached = json.load(f)
+        return tuple(cached['version']), cached['checked']
+    except (IOError, ValueError, KeyError, TypeError):
+        return None, 0
+
+def fetch_latest_version():
+    ''' The newest version on the course server, cached; None if it can't be had within VERSION_CHECK_TIMEOUT '''
+    import urllib.request
+    try:
+        with urllib.request.urlopen(VERSION_URL, timeout=VERSION_CHECK_TIMEOUT) as response:
+            latest = tuple(map(int, response.read().decode().strip().split('.')))
+    except (IOError, ValueError):
+        return None
+    try:
+        tmp_path = os.path.join(mydir, VERSION_CACHE + ".tmp")
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': latest, 'checked': time.time()}, f)
+        os.replace(tmp_path, os.path.join(mydir, VERSION_CACHE))
+    except (IOError, OSError):
+        pass
+    return latest
+
+class UpdateCheck(object):
+    '''
+    Looks for a newer client while the command runs: the cached answer if it is
+    fresh, otherwise from the course server on a background thread. finish()
+    offers the update once the command is done.
+    '''
+    def __init__(self):
+        self.latest, checked = read_cached_version()
+        self._thread = None
+        if self.latest is None or not (0 <= time.time() - checked < VERSION_CHECK_TTL):
+            self._thread = threading.Thread(target=self._fetch)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _fetch(self):
+        latest = fetch_latest_version()
+        if latest is not None:
+            self.latest = latest
+
+    def finish(self):
+        if self._thread is not None:
+            # Name resolution isn't covered by the socket timeout, so bound the wait here too
+            self._thread.join(VERSION_CHECK_TIMEOUT)
+        if self.latest is not None and self.latest > MY_VERSION:
+            offer_update()
+
+def offer_update():
+    print("Sorry! Not using the newest Miniplaces Client version.")
+    if not sys.stdin.isatty():
+        # Don't block a script on the prompt
+        print("Run this script from a terminal to update, or get it from:\n%s" % CLIENT_URL)
+        return
+    if input("May I update? (Y/N)").lower().startswith('y'):
+        import shutil
+        import urllib.request
+        print("Updating...")
+        try:
+            with urllib.request.urlopen(CLIENT_URL, timeout=30) as response:
+                updated = response.read()
+        except IOError:
+            print("Failed to fetch updates! Try going to:\n%s\nto manually replace this file" % CLIENT_URL)
+            sys.exit(1)
+        with open(os.path.join(mydir, "updated_client.py"), "wb") as f:
+            f.write(updated)
+        print("Swapping...")
+        shutil.copy2(os.path.join(mydir, "updated_client.py"), __file__)
+        try:
+            os.remove(os.path.join(mydir, "updated_client.py"))
+        except:
+            print("Couldn't remove updated_client.py. Please remove manually.")
+        print("Swap successful! (I think). Exiting... Rerun for latest updates")
+        sys.exit(0)
+
 
 def request_generate_teamid(team_name, kerb1, kerb2):
-    gen_id = client.generate_id(team_name, kerb1, kerb2)['team_id']
+    gen_id = get_client().generate_id(team_name, kerb1, kerb2)['team_id']
     with open(os.path.join(mydir, IDFILE), 'w') as f:
         f.write(gen_id)
         f.write("\n")
     print("Team ID generated and written to %s" % IDFILE)
 
 def read_id():
-    with open(os.path.join(mydir, IDFILE), 'r') as f:
-        team_id = f.read()
-    print("Using Team ID: %s" % team_id)
-    return team_id
+    ''' The team id from IDFILE, read and announced once per run '''
+    global _team_id
+    if _team_id is None:
+        with open(os.path.join(mydir, IDFILE), 'r') as f:
+            _team_id = f.read()
+        print("Using Team ID: %s" % _team_id)
+    return _team_id
 
 def get_teamid():
     if not os.path.exists(os.path.join(mydir, IDFILE)):
@@ -74,34 +157,184 @@ def get_teamid():
     team_id = read_id()
     return team_id
 
-def show_leaderboard():
-    response = client.get_leaderboard()
-    for rank, (team_name, score) in enumerate(response['scores'], 1):
+def fetch_leaderboard(top=None):
+    if top is None:
+        return get_client().get_leaderboard()['scores']
+    # Only the first page is sent
+    try:
+        scores = get_client().get_leaderboard(0, top)['scores']
+    except IOError as err:
+        # Servers without pagination don't take arguments, and fail the call
+        if getattr(err, 'status', None) != 400:
+            raise
+        scores = get_client().get_leaderboard()['scores']
+    return scores[:top]
+
+def show_leaderboard(top=None):
+    for rank, (team_name, score) in enumerate(fetch_leaderboard(top), 1):
         print("%2d. (%06.4f) %s" % (rank, float(score), team_name))
 
+def stream_refused(err):
+    '''
+    Whether a failed stream upload can't have been scored, so sending the file
+    again the old way can't count it twice: the server said it takes no
+    stream (415, or a submit without a stream argument), or the connection
+    was refused or reset before any response came back.
+    '''
+    status = getattr(err, 'status', None)
+    if status is not None:
+        return status == 415 or (status == 400 and b'does not take a stream' in bytes(err.content or b''))
+    # requests and urllib3 wrap the socket error a few layers down
+    pending, seen = [err], set()
+    while pending:
+        cause = pending.pop()
+        if cause is None or id(cause) in seen:
+            continue
+        seen.add(id(cause))
+        if isinstance(cause, (ConnectionRefusedError, ConnectionResetError, BrokenPipeError)):
+            return True
+        pending.extend([cause.__cause__, cause.__context__, getattr(cause, 'reason', None)])
+        pending.extend(arg for arg in cause.args if isinstance(arg, BaseException))
+    return False
+
+def rejected(err):
+    ''' Whether the server turned a request down for good (a 4xx other than timeouts and rate limits), so retrying it won't help '''
+    status = getattr(err, 'status', None)
+    return status is not None and 400 <= status < 500 and status not in (408, 429)
+
 def submit_file(fp):
-    with open(fp, 'r') as f:
-        predictions = json.load(f)
-    response = client.submit(get_teamid(), predictions)
+    client = get_client()
+    team_id = get_teamid()
+    try:
+        # Streams the file from disk, so big prediction files are never loaded whole
+        with open(fp, 'rb') as f:
+            response = client.submit.stream_upload(f, team_id)
+    except IOError as err:
+        # requests' errors are IOErrors too
+        if not stream_refused(err):
+            raise
+        # Servers without streaming turn the upload away before scoring it
+        with open(fp, 'r') as f:
+            predictions = json.load(f)
+        response = client.submit(team_id, predictions)
     sid = response['submission_id']
     print("Submitted %s. Submission ID: %s" % (os.path.basename(fp), sid))
 
 def show_my_scores():
-    response = client.get_my_scores(get_teamid())
+    response = get_client().get_my_scores(get_teamid())
     print("My submissions:")
     for (timestamp, team_name, score) in response['scores']:
         print("%s | %s" % (timestamp, score))
     
+def leaderboard_changes(old, new):
+    ''' Lines describing how the leaderboard new differs from old, both [[team_name, score], ...] '''
+    old_ranks = {team_name: (rank, score) for rank, (team_name, score) in enumerate(old, 1)}
+    lines = []
+    for rank, (team_name, score) in enumerate(new, 1):
+        if team_name not in old_ranks:
+            lines.append("%2d. (%06.4f) %s (new)" % (rank, float(score), team_name))
+            continue
+        old_rank, old_score = old_ranks[team_name]
+        if old_rank != rank or old_score != score:
+            lines.append("%2d. (%06.4f) %s (was %d. (%06.4f))" % (rank, float(score), team_name, old_rank, float(old_score)))
+    return lines
+
+def score_changes(old, new):
+    ''' Lines for submissions in new, [[timestamp, team_name, score], ...], that are new or rescored since old '''
+    lines = []
+    for i, (timestamp, team_name, score) in enumerate(new):
+        if i >= len(old) or old[i][0] != timestamp:
+            lines.append("New submission: %s | %s" % (timestamp, score))
+        elif old[i][2] != score:
+            lines.append("Scored: %s | %s (was %s)" % (timestamp, score, old[i][2]))
+    return lines
+
+def list_predictions(directory):
+    ''' {path: (size, mtime)} of the .json files in directory '''
+    found = {}
+    for fn in os.listdir(directory):
+        path = os.path.join(directory, fn)
+        if fn.endswith('.json') and os.path.isfile(path):
+            stat = os.stat(path)
+            found[path] = (stat.st_size, stat.st_mtime)
+    return found
+
+def watch(interval, directory=None, top=None, max_backoff=600):
+    '''
+    Polls the leaderboard and my scores every interval seconds on one
+    connection, printing only what changed. Unchanged responses come back as
+    bodiless 304s from servers that send ETags. With directory, .json files
+    that appear there afterwards are submitted once they stop growing.
+    Errors back off exponentially, up to max_backoff seconds.
+    '''
+    if directory is not None and not os.path.isdir(directory):
+        print("Could not find the folder:\n%s" % directory)
+        sys.exit(1)
+    team_id = get_teamid()
+    leaderboard, my_scores = [], []
+    # Files already there were submitted (or not) by hand
+    submitted = set(list_predictions(directory)) if directory is not None else set()
+    pending = {}
+    delay = interval
+    print("Watching every %gs, Ctrl-C to stop" % interval)
+    while True:
+        stamp = time.strftime('%H:%M:%S')
+        try:
+            if directory is not None:
+                for path, signature in sorted(list_predictions(directory).items()):
+                    if path in submitted:
+                        continue
+                    if pending.get(path) == signature:
+                        # Unchanged since the last look, so it's done being written
+                        try:
+                            submit_file(path)
+                        except (IOError, ValueError) as err:
+                            # Not valid JSON, or the server refused it: sending it again won't help.
+                            # Anything else is a transport error, and backs off below
+                            if isinstance(err, IOError) and not rejected(err):
+                                raise
+                            print("%s Skipping %s: %s" % (stamp, os.path.basename(path), err))
+                        submitted.add(path)
+                        del pending[path]
+                    else:
+                        pending[path] = signature
+            new_leaderboard = fetch_leaderboard(top)
+            for line in leaderboard_changes(leaderboard, new_leaderboard):
+                print("%s %s" % (stamp, line))
+            leaderboard = new_leaderboard
+            new_scores = get_client().get_my_scores(team_id)['scores']
+            for line in score_changes(my_scores, new_scores):
+                print("%s %s" % (stamp, line))
+            my_scores = new_scores
+            delay = interval
+        # requests' errors are IOErrors too
+        except (IOError, ValueError) as err:
+            delay = min(max_backoff, delay * 2)
+            print("%s Error: %s. Retrying in %gs" % (stamp, err, delay))
+        time.sleep(delay)
+
 def show_aws_credits():
-    response = client.get_aws_credit(get_teamid())
+    response = get_client().get_aws_credit(get_teamid())
     print("My AWS credit (email if you need more - we do not expect this, though):")
     print(response['credits'])
 
 
+def print_timing(command_started):
+    ''' Startup runs until the first client is built, the command from there '''
+    ready = _client_ready if _client_ready is not None else command_started
+    startup = ready - STARTED
+    print("Startup: %.3fs%s" % (startup, " (over the %.3fs budget!)" % STARTUP_BUDGET if startup > STARTUP_BUDGET else ""))
+    print("Command: %.3fs" % (time.perf_counter() - ready))
+
+
 def parse_args():
     parser = argparse.ArgumentParser("Submits / Views Submissions to the 6.869 Miniplaces Challenge Server")
-    parser.add_argument("mode", choices=["leaderboard","submit","view", "aws"], help="What operation to do. View the leaderboard (leaderboard), submit predictions (submit), get AWS credits (aws) or view your previous scores (view)")
-    parser.add_argument("submission", type=os.path.abspath, nargs='?', default=None, help="The .json file to submit")
+    parser.add_argument("mode", choices=["leaderboard","submit","view", "aws", "watch"], help="What operation to do. View the leaderboard (leaderboard), submit predictions (submit), get AWS credits (aws), view your previous scores (view) or keep printing leaderboard and score changes (watch)")
+    parser.add_argument("submission", type=os.path.abspath, nargs='?', default=None, help="The .json file to submit, or for watch, a folder whose new .json files get submitted")
+    parser.add_argument("--interval", type=float, default=60, help="Seconds between polls in watch mode")
+    parser.add_argument("--top", type=int, default=None, help="Only show the first TOP teams of the leaderboard")
+    parser.add_argument("--offline", action="store_true", default=bool(os.environ.get("MINIPLACES_OFFLINE")), help="Don't check for client updates (also set by MINIPLACES_OFFLINE=1)")
+    parser.add_argument("--timing", action="store_true", help="Print how long startup and the command took")
     args = parser.parse_args()
     if 'mode' == 'submit':
         if args.submission is None:
@@ -114,10 +347,11 @@ def parse_args():
 
 
 def main():
-    check_for_updates()
     args = parse_args()
+    update_check = None if args.offline else UpdateCheck()
+    command_started = time.perf_counter()
     if args.mode == 'leaderboard':
-        show_leaderboard()
+        show_leaderboard(args.top)
     elif args.mode == 'submit':
         submit_file(args.submission)
         # Show the scores if you just submitted
@@ -126,6 +360,15 @@ def main():
         show_aws_credits()
     if args.mode == 'view':
         show_my_scores()
+    if args.mode == 'watch':
+        try:
+            watch(args.interval, args.submission, args.top)
+        except KeyboardInterrupt:
+            print("Stopped watching")
+    if args.timing:
+        print_timing(command_started)
+    if update_check is not None:
+        update_check.finish()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+'''
+Reference challenge server: the other side of miniplaces_grader.py, for testing
+offline. Serve the validation set (or any labelled folder) with
+
+    python miniplaces_server.py --labels data/val --port 39284
+
+and point the grader at it with MINIPLACES_SERVER=localhost:39284.
+'''
+
+import os
+import sys
+import json
+import uuid
+import argparse
+import bisect
+import itertools
+import datetime
+import threading
+import numpy
+import webpy
+
+if sys.version_info < (3,0,0):
+    print("ERROR: Please run with Python 3!")
+    sys.exit()
+
+def pad_guesses(labels, k):
+    ''' labels cut or padded with '' to k entries; anything but a list counts as no guesses '''
+    labels = labels[:k] if type(labels) is list else []
+    return labels + [''] * (k - len(labels))
+
+class GroundTruth(object):
+    '''
+    The labels of a test set, indexed once. A submission is turned into arrays
+    of row and class numbers, with dict lookups run by map() (no Python loop per
+    file) for a dict, or row by row as a stream is read, then scored with array
+    comparisons.
+    '''
+    def __init__(self, labels):
+        ''' labels is {filename: class name} '''
+        self.filenames = sorted(labels)
+        self.classes = sorted(set(labels.values()))
+        self.row_of = {fn: i for i, fn in enumerate(self.filenames)}
+        self.class_of = {name: i for i, name in enumerate(self.classes)}
+        self.truth = numpy.array([self.class_of[labels[fn]] for fn in self.filenames], dtype=numpy.intp)
+
+    @staticmethod
+    def from_json(fp):
+        with open(fp, 'r') as f:
+            return GroundTruth(json.load(f))
+
+    @staticmethod
+    def from_image_folder(root):
+        ''' Labels from a root/<class name>/<file>.jpg tree, like the notebook's datasets '''
+        labels = {}
+        for parentdir, subdirs, subfns in os.walk(root):
+            class_name = os.path.relpath(parentdir, root)
+            labels.update({fn: class_name for fn in subfns if fn.endswith('.jpg')})
+        return GroundTruth(labels)
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def lookup(self, index, keys, count):
+        ''' index[key] for each of the count keys, -1 where it is missing '''
+        return numpy.fromiter(map(index.get, keys, itertools.repeat(-1)), dtype=numpy.intp, count=count)
+
+    def score(self, predictions, k=5):
+        '''
+        Scores {filename: [k class names, best first]}, a dict or a stream of
+        its JSON (see webpy.iter_json_items). Files missing from the
+        submission count as wrong; unknown files and class names are ignored.
+        Returns {'top1': accuracy, 'top5': accuracy, 'matched': files scored}
+        '''
+        if isinstance(predictions, dict):
+            rows, guessed = self.index_dict(predictions, k)
+        else:
+            rows, guessed = self.index_stream(predictions, k)
+        hits = guessed == self.truth[rows][:, None]
+        return {'top1': float(numpy.count_nonzero(hits[:, 0])) / len(self),
+                'top5': float(numpy.count_nonzero(hits.any(axis=1))) / len(self),
+                'matched': len(rows)}
+
+    def index_dict(self, predictions, k):
+        ''' (rows of the known files, their guessed class numbers [files, k]) for a dict of predictions '''
+        filenames, guesses = list(predictions), list(predictions.values())
+        if not filenames:
+            return numpy.zeros(0, dtype=numpy.intp), numpy.zeros((0, k), dtype=numpy.intp)
+        if not all(type(labels) is list and len(labels) == k for labels in guesses):
+            guesses = [pad_guesses(labels, k) for labels in guesses]
+        flat = itertools.chain.from_iterable(guesses)
+        try:
+            guessed = self.lookup(self.class_of, flat, len(filenames) * k)
+        except TypeError:
+            # Something unhashable where a class name should be
+            flat = map(str, itertools.chain.from_iterable(guesses))
+            guessed = self.lookup(self.class_of, flat, len(filenames) * k)
+        guessed = guessed.reshape(len(filenames), k)
+        rows = self.lookup(self.row_of, filenames, len(filenames))
+        known = rows >= 0
+        rows, first = numpy.unique(rows[known], return_index=True)
+        return rows, guessed[known][first]
+
+    def index_stream(self, predictions, k):
+        '''
+        index_dict for a stream of predictions. Guesses go straight into an
+        array with a row per file of the test set as they are read, so no list
+        of the whole submission is ever built.
+        '''
+        guessed = numpy.full((len(self), k), -1, dtype=numpy.intp)
+        listed = numpy.zeros(len(self), dtype=bool)
+        row_of, class_of = self.row_of, self.class_of
+        for filename, labels in webpy.iter_json_items(predictions):
+            row = row_of.get(filename, -1)
+            # Unknown files are ignored, and a file listed twice is only scored once
+            if row < 0 or listed[row]:
+                continue
+            listed[row] = True
+            if type(labels) is not list or len(labels) != k:
+                labels = pad_guesses(labels, k)
+            try:
+                guessed[row] = [class_of.get(name, -1) for name in labels]
+            except TypeError:
+                # Something unhashable where a class name should be
+                guessed[row] = [class_of.get(str(name), -1) for name in labels]
+        rows = numpy.flatnonzero(listed)
+        return rows, guessed[rows]
+
+class Leaderboard(object):
+    '''
+    Every team's best score, kept in rank order as submissions come in rather
+    than rebuilt per request. Ranks are (-score, time of the score, team id),
+    so ties go to whoever got there first. A new best is placed with a binary
+    search; the list shift that follows is a memmove, far cheaper at class
+    sizes than any tree written in Python.
+    '''
+    def __init__(self):
+        self.ranking = []
+        self.best = {}
+
+    def __len__(self):
+        return len(self.ranking)
+
+    def record(self, team_id, score, timestamp):
+        ''' Returns True if score is the team's new best '''
+        rank = (-score, timestamp, team_id)
+        previous = self.best.get(team_id)
+        if previous is not None:
+            if previous <= rank:
+                return False
+            del self.ranking[bisect.bisect_left(self.ranking, previous)]
+        bisect.insort(self.ranking, rank)
+        self.best[team_id] = rank
+        return True
+
+    def page(self, offset=0, limit=None):
+        ''' [(team_id, score), ...] from rank offset + 1, at most limit of them '''
+        end = None if limit is None else offset + limit
+        return [(team_id, -negated_score) for negated_score, timestamp, team_id in self.ranking[offset:end]]
+
+class ChallengeLog(object):
+    '''
+    Append-only record of everything the challenge server changes, one JSON
+    object per line, so a restart replays it instead of rescoring anything.
+    A line cut short by a crash is dropped. With sync=True each record is
+    fsynced before the call returns.
+    '''
+    def __init__(self, fp, sync=False):
+        self.fp = fp
+        self.sync = sync
+        self._file = None
+
+    def replay(self):
+        ''' Yields every record, then opens the log for appending '''
+        records = []
+        if os.path.exists(self.fp):
+            with open(self.fp, 'rb') as f:
+                data = f.read()
+            complete = data[:data.rfind(b'\n') + 1]
+            if len(complete) < len(data):
+                # Torn write: cut it off, or the next record would be appended to it
+                with open(self.fp, 'r+b') as f:
+                    f.truncate(len(complete))
+            records = [json.loads(line) for line in complete.decode('utf-8').splitlines() if line.strip()]
+        self._file = open(self.fp, 'a', encoding='utf-8')
+        return records
+
+    def append(self, record):
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+        if self.sync:
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+class MiniplacesChallenge(object):
+    '''
+    Function provider for webpy.expose, answering with the response shapes
+    miniplaces_grader.py parses. Submissions are scored on arrival by top-5
+    accuracy. aws_credits is a list of codes, one handed to each team that asks.
+
+    Every change is a record applied the same way live and when replaying
+    log_path (a ChallengeLog), so state survives restarts. Leaderboard and
+    score responses are cached by the server until a submission comes in.
+    '''
+    def __init__(self, ground_truth, aws_credits=(), log_path=None, sync=False):
+        self.ground_truth = ground_truth
+        self.aws_credits = list(aws_credits)
+        self.teams = {}
+        self.submissions = {}
+        self.submission_times = {}
+        self.credits_given = {}
+        self.leaderboard = Leaderboard()
+        self._lock = threading.RLock()
+        self.log = None
+        if log_path is not None:
+            self.log = ChallengeLog(log_path, sync)
+            for record in self.log.replay():
+                self.apply(record)
+            given = set(self.credits_given.values())
+            self.aws_credits = [code for code in self.aws_credits if code not in given]
+
+    def get_allowed_webpy_paths(self):
+        return ['/generate_id', '/submit', '/get_leaderboard', '/get_my_scores', '/get_aws_credit']
+
+    def apply(self, record):
+        ''' Applies one change; the caller holds the lock (or is replaying) '''
+        team_id = record['team_id']
+        if record['type'] == 'team':
+            self.teams[team_id] = {'team_name': record['team_name'], 'kerbs': record['kerbs']}
+            self.submissions[team_id] = []
+            self.submission_times[team_id] = []
+        elif record['type'] == 'submission':
+            timestamp, score = record['timestamp'], record['top5']
+            self.submissions[team_id].append([timestamp, self.teams[team_id]['team_name'], score])
+            self.submission_times[team_id].append(timestamp)
+            self.leaderboard.record(team_id, score, timestamp)
+        elif record['type'] == 'credit':
+            self.credits_given[team_id] = record['code']
+
+    def commit(self, record):
+        ''' Logs and applies a change made by a call '''
+        with self._lock:
+            if self.log is not None:
+                self.log.append(record)
+            self.apply(record)
+
+    def generate_id(self, team_name, kerb1, kerb2):
+        team_id = uuid.uuid4().hex
+        self.commit({'type': 'team', 'team_id': team_id, 'team_name': team_name,
+                     'kerbs': [kerb for kerb in (kerb1, kerb2) if kerb]})
+        return {'team_id': team_id}
+
+    def team_name(self, team_id):
+        team = self.teams.get(team_id.strip())
+        if team is None:
+            raise ValueError('Unknown team id %s' % team_id)
+        return team['team_name']
+
+    @webpy.invalidates('/get_leaderboard', '/get_my_scores')
+    @webpy.streamed('predictions')
+    def submit(self, team_id, predictions):
+        self.team_name(team_id)
+        result = self.ground_truth.score(predictions)
+        submission_id = uuid.uuid4().hex
+        self.commit({'type': 'submission', 'team_id': team_id.strip(), 'submission_id': submission_id,
+                     'timestamp': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                     'top1': result['top1'], 'top5': result['top5']})
+        return {'submission_id': submission_id}
+
+    @webpy.cached()
+    def get_leaderboard(self, offset=0, limit=None):
+        ''' Best score per team, best first; a page of limit teams from rank offset + 1 if given '''
+        with self._lock:
+            page = self.leaderboard.page(offset, limit)
+            scores = [[self.teams[team_id]['team_name'], score] for team_id, score in page]
+            return {'scores': scores, 'offset': offset, 'total': len(self.leaderboard)}
+
+    @webpy.cached()
+    def get_my_scores(self, team_id, since=None):
+        ''' The team's submissions, oldest first; only those after the since timestamp if given '''
+        self.team_name(team_id)
+        team_id = team_id.strip()
+        with self._lock:
+            start = 0 if since is None else bisect.bisect_right(self.submission_times[team_id], since)
+            return {'scores': self.submissions[team_id][start:]}
+
+    def get_aws_credit(self, team_id):
+        self.team_name(team_id)
+        team_id = team_id.strip()
+        with self._lock:
+            if team_id not in self.credits_given and self.aws_credits:
+                self.commit({'type': 'credit', 'team_id': team_id, 'code': self.aws_credits.pop()})
+            code = self.credits_given.get(team_id)
+        return {'credits': code if code is not None else 'None left'}
+
+def load_ground_truth(labels):
+    if os.path.isdir(labels):
+        return GroundTruth.from_image_folder(labels)
+    return GroundTruth.from_json(labels)
+
+def parse_args():
+    parser = argparse.ArgumentParser("Runs a local 6.869 Miniplaces Challenge Server")
+    parser.add_argument("--labels", required=True, help="Ground truth: a {filename: class name} .json file, or a folder of <class name>/<file>.jpg")
+    parser.add_argument("--host", default="localhost", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=39284, help="Port to listen on")
+    parser.add_argument("--aws-credits", default=None, help="A file with one AWS credit code per line")
+    parser.add_argument("--log", default="challenge_log.jsonl", help="Append-only log of teams and scores, replayed on start")
+    parser.add_argument("--sync", action="store_true", help="fsync the log after every change")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    ground_truth = load_ground_truth(args.labels)
+    aws_credits = []
+    if args.aws_credits is not None:
+        with open(args.aws_credits, 'r') as f:
+            aws_credits = [line.strip() for line in f if line.strip()]
+    challenge = MiniplacesChallenge(ground_truth, aws_credits, log_path=args.log, sync=args.sync)
+    server = webpy.WebPyServer(args.host, args.port, challenge, webpy.WebPyJSONCodec, thread_calls=True)
+    print("Scoring against %d labelled images on %s:%d" % (len(ground_truth), args.host, args.port))
+    server.start_server(new_thread=False)
+
+if __name__ == "__main__":
+    main()
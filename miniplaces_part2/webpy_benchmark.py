@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+'''
+Load tests a WebPy server on localhost with a stand-in for the challenge server.
+
+Every combination of --engines, --codecs, --concurrency and --payloads is run
+against a fresh server in its own process, so the load generator doesn't share
+the server's GIL. Results go to --output as JSON, to compare runs:
+
+    python webpy_benchmark.py --engines threaded,async --concurrency 1,8 --output before.json
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import platform
+import threading
+import multiprocessing
+import webpy
+
+try:
+    import resource
+except ImportError:
+    # Not on Windows; memory is then reported as None
+    resource = None
+
+if sys.version_info < (3,0,0):
+    print("ERROR: Please run with Python 3!")
+    sys.exit()
+
+HOSTNAME = '127.0.0.1'
+
+ENGINES = {
+    'single': (webpy.WebPyServer, {}),
+    'threaded': (webpy.WebPyServer, {'thread_calls': True}),
+    'async': (webpy.WebPyAsyncServer, {}),
+}
+
+CODECS = {
+    'json': webpy.WebPyJSONCodec,
+    'pickle': webpy.WebPyBinaryCodec,
+    'compact': webpy.WebPyCompactCodec,
+}
+
+# Share of requests going to each call, roughly what the grader sends near a deadline
+DEFAULT_MIX = 'submit=1,get_leaderboard=6,get_my_scores=3'
+
+CLASS_NAMES = ['class_%03d' % i for i in range(100)]
+
+class StandInChallenge(object):
+    '''
+    Answers like the challenge server, with the same response shapes the
+    grader parses, but scores by comparing against random labels.
+    '''
+    def __init__(self, num_teams=200, seed=0):
+        rng = random.Random(seed)
+        self.scores = [['team_%03d' % i, rng.random()] for i in range(num_teams)]
+        self.scores.sort(key=lambda entry: -entry[1])
+        self.submissions = {}
+        self._lock = threading.Lock()
+
+    def submit(self, team_id, predictions):
+        top5_hits = sum(1 for labels in predictions.values() if 'class_000' in labels)
+        with self._lock:
+            history = self.submissions.setdefault(team_id, [])
+            history.append([time.strftime('%Y-%m-%d %H:%M:%S'), team_id, top5_hits / max(1, len(predictions))])
+            submission_id = '%s-%d' % (team_id, len(history))
+        return {'submission_id': submission_id}
+
+    def get_leaderboard(self):
+        return {'scores': self.scores}
+
+    def get_my_scores(self, team_id):
+        with self._lock:
+            return {'scores': list(self.submissions.get(team_id, []))}
+
+def make_predictions(num_images, seed=0):
+    ''' A submission of num_images images, shaped like the notebook's test_set_predictions json '''
+    rng = random.Random(seed)
+    return {'%08d.jpg' % (i + 1): rng.sample(CLASS_NAMES, 5) for i in range(num_images)}
+
+def find_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind((HOSTNAME, 0))
+        return s.getsockname()[1]
+
+def peak_rss_kb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, kilobytes elsewhere
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+def run_server(engine, codec_name, port, ready, conn):
+    ''' Server process: serves until anything arrives on conn, then sends back its stats '''
+    server_class, options = ENGINES[engine]
+    server = server_class(HOSTNAME, port, StandInChallenge(), CODECS[codec_name], **options)
+    # Request logging would dominate the measurement
+    if isinstance(server, webpy.WebPyServer):
+        server.handler.log_message = lambda *args: None
+    start_rss = peak_rss_kb()
+    server.start_server()
+    ready.set()
+    conn.recv()
+    conn.send({'peak_rss_kb': peak_rss_kb(), 'start_rss_kb': start_rss, 'routes': server.metrics.summary()})
+    server.stop_server()
+
+def percentile(ordered, q):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+def parse_mix(mix):
+    calls = []
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        calls.append((name.strip(), float(weight or 1)))
+    return calls
+
+def run_load(port, codec_name, concurrency, num_images, mix, duration, warmup):
+    '''
+    Drives the server from concurrency threads, each with its own client, for
+    duration seconds after warmup seconds. Returns per-call latencies and error counts.
+    '''
+    predictions = make_predictions(num_images)
+    calls = parse_mix(mix)
+    names = [name for name, weight in calls]
+    weights = [weight for name, weight in calls]
+    latencies = {name: [] for name in names}
+    errors = {name: 0 for name in names}
+    lock = threading.Lock()
+    measure_from = time.perf_counter() + warmup
+    stop_at = measure_from + duration
+
+    def worker(worker_ix):
+        client = webpy.make_client(HOSTNAME, port, CODECS[codec_name], timeout=30)
+        team_id = 'team_%03d' % worker_ix
+        rng = random.Random(worker_ix)
+        mine = {name: [] for name in names}
+        failed = {name: 0 for name in names}
+        while True:
+            name = rng.choices(names, weights)[0]
+            start = time.perf_counter()
+            if start >= stop_at:
+                break
+            try:
+                if name == 'submit':
+                    client.submit(team_id, predictions)
+                elif name == 'get_my_scores':
+                    client.get_my_scores(team_id)
+                else:
+                    getattr(client, name)()
+                ok = True
+            except Exception:
+                ok = False
+            if start >= measure_from:
+                if ok:
+                    mine[name].append(time.perf_counter() - start)
+                else:
+                    failed[name] += 1
+        with lock:
+            for name in names:
+                latencies[name].extend(mine[name])
+                errors[name] += failed[name]
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for thr in threads:
+        thr.start()
+    for thr in threads:
+        thr.join()
+    return latencies, errors
+
+def run_scenario(engine, codec_name, concurrency, num_images, args):
+    port = find_free_port()
+    ready = multiprocessing.Event()
+    parent_conn, child_conn = multiprocessing.Pipe()
+    server_process = multiprocessing.Process(target=run_server, args=(engine, codec_name, port, ready, child_conn))
+    server_process.daemon = True
+    server_process.start()
+    try:
+        if not ready.wait(30):
+            raise RuntimeError('The %s server did not start' % engine)
+        latencies, errors = run_load(port, codec_name, concurrency, num_images, args.mix, args.duration, args.warmup)
+        parent_conn.send('stop')
+        server_stats = parent_conn.recv()
+    finally:
+        server_process.join(10)
+        if server_process.is_alive():
+            server_process.terminate()
+    calls = {}
+    all_latencies = []
+    for name, measured in latencies.items():
+        measured.sort()
+        all_latencies.extend(measured)
+        calls[name] = {'requests': len(measured), 'errors': errors[name],
+            'p50_ms': ms(percentile(measured, 0.5)), 'p95_ms': ms(percentile(measured, 0.95)),
+            'p99_ms': ms(percentile(measured, 0.99))}
+    all_latencies.sort()
+    return {
+        'engine': engine, 'codec': codec_name, 'concurrency': concurrency, 'payload_images': num_images,
+        'duration_s': args.duration, 'requests': len(all_latencies), 'errors': sum(errors.values()),
+        'throughput_rps': len(all_latencies) / args.duration,
+        'p50_ms': ms(percentile(all_latencies, 0.5)), 'p95_ms': ms(percentile(all_latencies, 0.95)),
+        'p99_ms': ms(percentile(all_latencies, 0.99)),
+        'server_peak_rss_kb': server_stats['peak_rss_kb'], 'server_start_rss_kb': server_stats['start_rss_kb'],
+        'calls': calls, 'server_routes': server_stats['routes'],
+    }
+
+def ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+def describe_environment():
+    return {'python': platform.python_version(), 'platform': platform.platform(),
+            'cpus': os.cpu_count(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+def split_list(value, kind=str):
+    return [kind(item) for item in value.split(',') if item]
+
+def parse_args():
+    parser = argparse.ArgumentParser("Load tests WebPy engines and codecs on localhost")
+    parser.add_argument("--engines", type=split_list, default=['threaded', 'async'], help="Comma separated, out of %s" % ', '.join(ENGINES))
+    parser.add_argument("--codecs", type=split_list, default=['json'], help="Comma separated, out of %s" % ', '.join(CODECS))
+    parser.add_argument("--concurrency", type=lambda v: split_list(v, int), default=[1, 8], help="Comma separated client thread counts")
+    parser.add_argument("--payloads", type=lambda v: split_list(v, int), default=[10000], help="Comma separated image counts per submission")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="Weighted calls, e.g. %s" % DEFAULT_MIX)
+    parser.add_argument("--duration", type=float, default=5.0, help="Seconds measured per scenario")
+    parser.add_argument("--warmup", type=float, default=1.0, help="Seconds run before measuring")
+    parser.add_argument("--output", default=None, help="JSON file for the results")
+    args = parser.parse_args()
+    for engine in args.engines:
+        if engine not in ENGINES:
+            parser.error("Unknown engine %s" % engine)
+    for codec_name in args.codecs:
+        if codec_name not in CODECS:
+            parser.error("Unknown codec %s" % codec_name)
+    return args
+
+def main():
+    args = parse_args()
+    results = {'environment': describe_environment(), 'mix': args.mix, 'runs': []}
+    print("%-9s %-8s %5s %8s %10s %9s %9s %9s %7s %10s" % ('engine', 'codec', 'conc', 'images', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'errors', 'rss KB'))
+    for engine in args.engines:
+        for codec_name in args.codecs:
+            for concurrency in args.concurrency:
+                for num_images in args.payloads:
+                    run = run_scenario(engine, codec_name, concurrency, num_images, args)
+                    results['runs'].append(run)
+                    print("%-9s %-8s %5d %8d %10.1f %9s %9s %9s %7d %10s" % (engine, codec_name, concurrency, num_images,
+                        run['throughput_rps'], run['p50_ms'], run['p95_ms'], run['p99_ms'], run['errors'], run['server_peak_rss_kb']))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print("Wrote results to %s" % os.path.abspath(args.output))
+
+if __name__ == "__main__":
+    main()